@@ -0,0 +1,52 @@
+import hashlib
+import logging
+import os
+import time
+from typing import Dict, Optional
+from urllib.parse import urlencode
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '.cache'
+
+def cache_key(url: str, params: Optional[Dict] = None) -> str:
+    """Build a cache key from the SHA-256 of the request URL and params"""
+    if params:
+        url = f"{url}?{urlencode(sorted(params.items()))}"
+    return hashlib.sha256(url.encode()).hexdigest()
+
+def _cache_path(key: str, cache_dir: str, ext: str) -> str:
+    """Shard cache files by the first two characters of the key"""
+    return os.path.join(cache_dir, key[:2], f"{key}.{ext}")
+
+def read_cache_bytes(key: str, ttl: float, cache_dir: str = CACHE_DIR, ext: str = 'bin') -> Optional[bytes]:
+    """Return cached raw bytes if they exist and are younger than ttl seconds"""
+    path = _cache_path(key, cache_dir, ext)
+    try:
+        if os.path.getmtime(path) < time.time() - ttl:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def write_cache_bytes(key: str, content: bytes, cache_dir: str = CACHE_DIR, ext: str = 'bin') -> None:
+    """Atomically write raw bytes to the cache"""
+    path = _cache_path(key, cache_dir, ext)
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"Error writing cache file {path}: {str(e)}")
+
+def read_cache(key: str, ttl: float, cache_dir: str = CACHE_DIR, ext: str = 'html') -> Optional[str]:
+    """Return cached content if it exists and is younger than ttl seconds"""
+    content = read_cache_bytes(key, ttl, cache_dir, ext)
+    return content.decode('utf-8') if content is not None else None
+
+def write_cache(key: str, content: str, cache_dir: str = CACHE_DIR, ext: str = 'html') -> None:
+    """Atomically write content to the cache"""
+    write_cache_bytes(key, content.encode('utf-8'), cache_dir, ext)
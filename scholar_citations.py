@@ -1,13 +1,14 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import csv
+import aiohttp
 import pandas as pd
 import time
-import random
 from datetime import datetime
 import logging
-from typing import List, Dict, Optional, Tuple
+from typing import Any, Callable, List, Dict, Optional, Tuple
 import re
-from urllib.parse import urlencode, urlparse, parse_qs
+from lxml import etree
+from response_cache import cache_key, read_cache_bytes, write_cache_bytes
 
 # Set up logging
 logging.basicConfig(
@@ -16,8 +17,46 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_YEAR_RE = re.compile(r'(?:20|19)\d{2}')
+_CITES_RE = re.compile(r'[?&]cites=([^&]+)')
+
+class TokenBucket:
+    """Rate limiter allowing bursts of up to burst requests on top of a steady rate"""
+    def __init__(self, rate_per_sec: float, burst: int):
+        self.rate = rate_per_sec
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        """Add the tokens accrued since the last update"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Take a token, waiting until it has accrued if the bucket is empty"""
+        self._refill()
+        # Reserve the token up front so concurrent callers queue behind each other
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
 class GoogleScholarScraper:
-    def __init__(self):
+    # Class tokens marking a single citing paper on a results page
+    _RESULT_CLASSES = {'gs_r', 'gs_or'}
+    # Precompiled XPath expressions for citation result pages
+    _XP_TITLE = etree.XPath("string(.//h3[@class='gs_rt'])")
+    _XP_LINK = etree.XPath(".//h3[@class='gs_rt']/a/@href")
+    _XP_BYLINE = etree.XPath("string(.//div[@class='gs_a'])")
+    _XP_SNIPPET = etree.XPath("string(.//div[@class='gs_rs'])")
+    # Scholar's CAPTCHA page, which is served with a 200: its form ids or the "sorry" form
+    _XP_BLOCKED = etree.XPath("boolean(//*[@id='gs_captcha_f' or @id='gs_captcha_ccl'] | //form[contains(@action,'sorry')])")
+    # Precompiled XPath expressions for the author's profile table
+    _XP_PROFILE_TITLE = etree.XPath("string(.//a[contains(@class,'gsc_a_at')])")
+    _XP_PROFILE_CITED_BY = etree.XPath(".//a[contains(@class,'gsc_a_ac')]/@href")
+
+    def __init__(self, cache_dir: str = '.cache', cache_ttl: float = 48 * 3600, no_cache: bool = False):
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.102 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
@@ -26,102 +65,171 @@ class GoogleScholarScraper:
             'Connection': 'keep-alive',
         }
         self.base_url = "https://scholar.google.com"
-        self.session = requests.Session()
+        # Parsed citing papers keyed by link (or title), shared across publications
+        self._seen_citations: Dict[str, Dict] = {}
+        self.output_fields = ['title', 'authors', 'venue', 'year', 'link', 'snippet', 'cited_paper']
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.semaphore: Optional[asyncio.BoundedSemaphore] = None
+        self.max_concurrency = 8
+        self.limit_per_host = 4
+        # Citation pages fetched concurrently past the first one
+        self.pages_ahead = 3
+        self.results_per_page = 10
+        self.pool_size = 32
+        self.keepalive_timeout = 60
+        self.chunk_size = 8192
+        # Retry policy, mirroring urllib3's Retry(total=5, backoff_factor=2, ...)
+        self.max_retries = 5
+        self.backoff_factor = 2
+        self.retry_statuses = {429, 500, 502, 503, 504}
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.no_cache = no_cache
+        # Roughly 20 requests a minute to Scholar, with short bursts allowed
+        self.bucket = TokenBucket(rate_per_sec=0.3, burst=5)
+        # Shared backoff deadline so a 429 pauses every in-flight request
+        self._backoff_until = 0.0
+
+    def _get_retry_wait(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Exponential backoff, preferring the server's Retry-After header when present"""
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+        return self.backoff_factor * 2 ** attempt
 
-    def _get_random_delay(self) -> float:
-        """Generate a random delay between requests"""
-        return random.uniform(2.0, 4.0)
+    def _is_blocked(self, body: bytes, results: List, encoding: Optional[str] = None) -> bool:
+        """Check whether a 200 response without results is actually Scholar's CAPTCHA page"""
+        if results:
+            return False
+        tree = etree.fromstring(body, etree.HTMLParser(encoding=encoding)) if body else None
+        return tree is not None and self._XP_BLOCKED(tree)
 
-    def _make_request(self, url: str, retries: int = 3) -> Optional[str]:
-        """Make HTTP request with retry logic"""
-        for attempt in range(retries):
+    def _new_parser(self, tag: str, encoding: Optional[str] = None) -> etree.HTMLPullParser:
+        """Create an incremental HTML parser reporting closed tag elements"""
+        return etree.HTMLPullParser(events=('end',), tag=tag, encoding=encoding)
+
+    def _extract_closed(self, parser: etree.HTMLPullParser, classes: set, extract: Callable[[etree._Element], Any], results: List) -> None:
+        """Extract every matching element the parser has closed so far"""
+        for elem in self._iter_elements(parser, classes):
+            item = extract(elem)
+            if item is not None:
+                results.append(item)
+
+    async def _make_request(self, url: str, tag: str, classes: set, extract: Callable[[etree._Element], Any], no_cache: bool = False) -> Optional[List]:
+        """Make HTTP request with retry logic, extracting matching tag elements as the page streams in"""
+        # Serve fresh responses from the disk cache
+        key = cache_key(url)
+        if not (no_cache or self.no_cache):
+            cached = read_cache_bytes(key, self.cache_ttl, self.cache_dir, ext='page')
+            if cached is not None:
+                logger.debug(f"Cache hit for URL: {url}")
+                # Cached pages are the raw body behind a line holding the response charset
+                charset, _, content = cached.partition(b'\n')
+                parser = self._new_parser(tag, charset.decode('ascii') or None)
+                results = []
+                for start in range(0, len(content), self.chunk_size):
+                    parser.feed(content[start:start + self.chunk_size])
+                    self._extract_closed(parser, classes, extract, results)
+                parser.close()
+                self._extract_closed(parser, classes, extract, results)
+                return results
+        
+        for attempt in range(self.max_retries + 1):
             try:
-                logger.debug(f"Requesting URL: {url}")
-                response = self.session.get(url, headers=self.headers, timeout=30)
-                
-                if response.status_code == 200:
-                    return response.text
-                elif response.status_code == 429:
-                    wait_time = (attempt + 1) * 60
-                    logger.warning(f"Rate limited. Waiting {wait_time} seconds...")
-                    time.sleep(wait_time)
+                # Honour any backoff triggered by a rate limited request, including
+                # one that arrived while this request was queued for a token
+                while True:
+                    await self.bucket.acquire()
+                    wait_time = self._backoff_until - time.monotonic()
+                    if wait_time <= 0:
+                        break
+                    await asyncio.sleep(wait_time)
+
+                async with self.semaphore:
+                    logger.debug(f"Requesting URL: {url}")
+                    async with self.session.get(url, headers=self.headers) as response:
+                        status = response.status
+                        retry_after = response.headers.get('Retry-After')
+                        if status == 200:
+                            # Parse chunks while the rest of the page is still arriving
+                            # Only trust an explicit charset, otherwise lxml reads <meta charset>
+                            encoding = response.charset
+                            parser = self._new_parser(tag, encoding)
+                            chunks = []
+                            results = []
+                            async for chunk in response.content.iter_chunked(self.chunk_size):
+                                parser.feed(chunk)
+                                self._extract_closed(parser, classes, extract, results)
+                                chunks.append(chunk)
+                            parser.close()
+                            self._extract_closed(parser, classes, extract, results)
+
+                if status == 200:
+                    body = b''.join(chunks)
+                    if self._is_blocked(body, results, encoding):
+                        # Don't cache the CAPTCHA page, back off as if rate limited
+                        logger.warning(f"Scholar served a CAPTCHA page for URL: {url}")
+                        status = 429
+                    else:
+                        write_cache_bytes(key, (encoding or '').encode('ascii') + b'\n' + body, self.cache_dir, ext='page')
+                        return results
+                if status not in self.retry_statuses:
+                    logger.warning(f"Request failed with status: {status}")
+                    return None
+                if attempt == self.max_retries:
+                    break
+                    
+                wait_time = self._get_retry_wait(attempt, retry_after)
+                logger.warning(f"Request failed with status {status}. Retrying in {wait_time} seconds...")
+                if status == 429:
+                    self._backoff_until = max(self._backoff_until, time.monotonic() + wait_time)
                 else:
-                    logger.warning(f"Request failed with status: {response.status_code}")
+                    await asyncio.sleep(wait_time)
             except Exception as e:
                 logger.error(f"Request error: {str(e)}")
-                if attempt < retries - 1:
-                    time.sleep(self._get_random_delay())
-        return None
-
-    def _extract_cluster_id(self, href: str) -> Optional[str]:
-        """Extract cluster ID from citation link"""
-        try:
-            parsed = urlparse(href)
-            params = parse_qs(parsed.query)
-            if 'cites' in params:
-                return params['cites'][0]
-        except Exception as e:
-            logger.error(f"Error extracting cluster ID: {str(e)}")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self._get_retry_wait(attempt))
+        
+        logger.error(f"Giving up on URL after {self.max_retries} retries: {url}")
         return None
 
-    def _get_cited_by_url(self, paper_html) -> Optional[str]:
+    def _get_cited_by_url(self, paper_html: etree._Element) -> Optional[str]:
         """Extract and construct proper 'Cited by' URL"""
         try:
-            cited_by_link = paper_html.find('a', class_='gsc_a_ac')
-            if cited_by_link and 'href' in cited_by_link.attrs:
-                # Extract the cluster ID from the href
-                cluster_id = self._extract_cluster_id(cited_by_link['href'])
-                if cluster_id:
-                    # Construct proper cited by URL
-                    params = {
-                        'cites': cluster_id,
-                        'hl': 'en',
-                        'sciodt': '0,5'
-                    }
-                    return f"{self.base_url}/scholar?{urlencode(params)}"
+            cited_by_hrefs = self._XP_PROFILE_CITED_BY(paper_html)
+            if cited_by_hrefs:
+                # Pull the cluster ID straight out of the href
+                match = _CITES_RE.search(cited_by_hrefs[0])
+                if match:
+                    return f"{self.base_url}/scholar?cites={match.group(1)}&hl=en&sciodt=0,5"
             return None
         except Exception as e:
             logger.error(f"Error getting cited by URL: {str(e)}")
             return None
 
-    def _get_total_citation_pages(self, content: str) -> int:
-        """Get total number of pages from citation results"""
-        try:
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Check for results
-            results = soup.find_all('div', class_='gs_r gs_or gs_scl')
-            if not results:
-                return 0
-                
-            # Look for pagination footer
-            footer = soup.find('div', id='gs_n')
-            if footer:
-                pages = footer.find_all('a')
-                if pages:
-                    try:
-                        return max([int(p.text) for p in pages if p.text.isdigit()])
-                    except ValueError:
-                        pass
-            
-            # If we found results but no pagination, we have one page
-            return 1
-            
-        except Exception as e:
-            logger.error(f"Error getting total pages: {str(e)}")
-            return 0
+    def _iter_elements(self, parser: etree.HTMLPullParser, classes: set):
+        """Yield each element closed by the parser so far that has all of classes"""
+        for _, elem in parser.read_events():
+            if classes.issubset(elem.get('class', '').split()):
+                yield elem
+                # Release the subtree and detach it once the caller is done with it
+                elem.clear()
+                parent = elem.getparent()
+                if parent is not None:
+                    parent.remove(elem)
 
-    def _parse_citing_paper(self, paper_html: BeautifulSoup) -> Dict:
+    def _parse_citing_paper(self, paper_html: etree._Element) -> Dict:
         """Parse a single citing paper"""
         try:
             # Extract title and link
-            title_section = paper_html.find('h3', class_='gs_rt')
-            title = title_section.get_text(strip=True) if title_section else ''
-            link = title_section.find('a')['href'] if title_section and title_section.find('a') else ''
+            title = self._XP_TITLE(paper_html).strip()
+            links = self._XP_LINK(paper_html)
+            link = str(links[0]) if links else ''
             
             # Extract authors, venue, year
-            byline = paper_html.find('div', class_='gs_a')
-            byline_text = byline.get_text(strip=True) if byline else ''
+            byline_text = self._XP_BYLINE(paper_html).strip()
             
             # Split byline
             parts = byline_text.split(' - ')
@@ -129,12 +237,11 @@ class GoogleScholarScraper:
             venue = parts[1] if len(parts) > 1 else ''
             
             # Extract year
-            year_match = re.search(r'20\d{2}|19\d{2}', byline_text)
+            year_match = _YEAR_RE.search(byline_text)
             year = year_match.group(0) if year_match else ''
             
             # Extract snippet
-            snippet = paper_html.find('div', class_='gs_rs')
-            snippet_text = snippet.get_text(strip=True) if snippet else ''
+            snippet_text = self._XP_SNIPPET(paper_html).strip()
             
             return {
                 'title': title,
@@ -149,110 +256,130 @@ class GoogleScholarScraper:
             logger.error(f"Error parsing citing paper: {str(e)}")
             return {}
 
-    def _get_citations_for_paper(self, cited_by_url: str, cited_paper_title: str, min_year: Optional[int] = None) -> List[Dict]:
+    def _parse_result(self, paper: etree._Element) -> Optional[Dict]:
+        """Parse a citing paper from a results page, reusing it if already seen"""
+        # Citing papers shared between publications are only parsed once
+        links = self._XP_LINK(paper)
+        key = str(links[0]) if links else self._XP_TITLE(paper).strip()
+        citation_data = self._seen_citations.get(key)
+        if citation_data is None:
+            citation_data = self._parse_citing_paper(paper)
+            if not citation_data:
+                return None
+            self._seen_citations[key] = citation_data
+        return citation_data
+
+    async def _get_citation_page(self, url: str) -> Optional[List[Dict]]:
+        """Fetch and parse the citing papers on a single results page"""
+        return await self._make_request(url, 'div', self._RESULT_CLASSES, self._parse_result)
+
+    async def _get_citations_for_paper(self, cited_by_url: str, cited_paper_title: str, min_year: Optional[int] = None) -> List[Dict]:
         """Get all citations for a single paper"""
         logger.info(f"Getting citations from URL: {cited_by_url}")
         citations = []
         
-        # Get first page and total pages
-        content = self._make_request(cited_by_url)
-        if not content:
+        # Get first page on its own, most papers fit on it
+        page_citations = await self._get_citation_page(cited_by_url)
+        if not page_citations:
             return citations
+        citations.extend({**c, 'cited_paper': cited_paper_title} for c in page_citations)
+        
+        # A short page is the last one, so only fetch ahead concurrently after a full page.
+        # An empty or failed page also ends the walk.
+        page = 1
+        while len(page_citations) >= self.results_per_page:
+            batch = range(page, page + self.pages_ahead)
+            pages = await asyncio.gather(*(
+                self._get_citation_page(f"{cited_by_url}&start={p * self.results_per_page}") for p in batch
+            ))
             
-        total_pages = self._get_total_citation_pages(content)
-        if total_pages == 0:
-            return citations
+            for p, page_citations in zip(batch, pages):
+                if not page_citations:
+                    return citations
+                citations.extend({**c, 'cited_paper': cited_paper_title} for c in page_citations)
+                logger.info(f"Processed page {p + 1}")
+                if len(page_citations) < self.results_per_page:
+                    return citations
             
-        # Process first page
-        soup = BeautifulSoup(content, 'html.parser')
-        papers = soup.find_all('div', class_='gs_r gs_or gs_scl')
-        
-        for paper in papers:
-            citation_data = self._parse_citing_paper(paper)
-            if citation_data:
-                citation_data['cited_paper'] = cited_paper_title
-                citations.append(citation_data)
+            page += self.pages_ahead
         
-        # Process remaining pages
-        for page in range(1, total_pages):
-            start_idx = page * 10
-            page_url = f"{cited_by_url}&start={start_idx}"
-            
-            content = self._make_request(page_url)
-            if not content:
-                break
+        return citations
+
+    async def _get_citations_for_profile_row(self, paper_title: str, cited_by_url: Optional[str], i: int, total_papers: int, min_year: Optional[int] = None) -> List[Dict]:
+        """Get citations for one row of the author's profile table"""
+        try:
+            if not cited_by_url:
+                return []
                 
-            soup = BeautifulSoup(content, 'html.parser')
-            papers = soup.find_all('div', class_='gs_r gs_or gs_scl')
+            logger.info(f"Processing paper {i}/{total_papers}: {paper_title}")
+            citations = await self._get_citations_for_paper(cited_by_url, paper_title, min_year)
             
-            for paper in papers:
-                citation_data = self._parse_citing_paper(paper)
-                if citation_data:
-                    citation_data['cited_paper'] = cited_paper_title
-                    citations.append(citation_data)
+            # Filter by year if needed
+            if min_year:
+                citations = [c for c in citations if c.get('year') and c['year'].isdigit() and int(c['year']) >= min_year]
             
-            logger.info(f"Processed page {page + 1} of {total_pages}")
-            time.sleep(self._get_random_delay())
-        
-        return citations
+            logger.info(f"Found {len(citations)} citations for {paper_title}")
+            return citations
+            
+        except Exception as e:
+            logger.error(f"Error processing paper: {str(e)}")
+            return []
 
-    def get_all_citations(self, scholar_id: str, min_year: Optional[int] = None) -> pd.DataFrame:
+    async def get_all_citations(self, scholar_id: str, min_year: Optional[int] = None) -> pd.DataFrame:
         """Get all papers citing the author's work"""
-        # Get author's papers
-        profile_url = f"{self.base_url}/citations?user={scholar_id}&hl=en&pagesize=100"
-        content = self._make_request(profile_url)
-        
-        if not content:
-            logger.error("Could not access profile")
-            return pd.DataFrame()
-            
-        soup = BeautifulSoup(content, 'html.parser')
-        papers = soup.find_all('tr', class_='gsc_a_tr')
+        self.semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        timeout = aiohttp.ClientTimeout(total=30)
+        self._seen_citations = {}
         
-        all_citations = []
-        total_papers = len(papers)
-        logger.info(f"Found {total_papers} papers to process")
-        
-        for i, paper in enumerate(papers, 1):
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
             try:
-                # Get paper title and citation URL
-                title_elem = paper.find('a', class_='gsc_a_at')
-                paper_title = title_elem.text if title_elem else 'Unknown Title'
+                # Get author's papers
+                profile_url = f"{self.base_url}/citations?user={scholar_id}&hl=en&pagesize=100"
+                # Get paper titles and citation URLs, each row is dropped once parsed
+                papers = await self._make_request(
+                    profile_url, 'tr', {'gsc_a_tr'},
+                    lambda row: (self._XP_PROFILE_TITLE(row) or 'Unknown Title', self._get_cited_by_url(row))
+                )
                 
-                cited_by_url = self._get_cited_by_url(paper)
-                if cited_by_url:
-                    logger.info(f"Processing paper {i}/{total_papers}: {paper_title}")
-                    citations = self._get_citations_for_paper(cited_by_url, paper_title, min_year)
-                    
-                    # Filter by year if needed
-                    if min_year:
-                        citations = [c for c in citations if c.get('year') and c['year'].isdigit() and int(c['year']) >= min_year]
-                    
-                    all_citations.extend(citations)
-                    logger.info(f"Found {len(citations)} citations for this paper")
+                if papers is None:
+                    logger.error("Could not access profile")
+                    return pd.DataFrame()
                 
-                time.sleep(self._get_random_delay())
+                total_papers = len(papers)
+                logger.info(f"Found {total_papers} papers to process")
                 
-            except Exception as e:
-                logger.error(f"Error processing paper: {str(e)}")
-                continue
+                results = await asyncio.gather(*(
+                    self._get_citations_for_profile_row(paper_title, cited_by_url, i, total_papers, min_year)
+                    for i, (paper_title, cited_by_url) in enumerate(papers, 1)
+                ))
+            finally:
+                self.session = None
+        
+        all_citations = [c for citations in results for c in citations]
         
-        # Create DataFrame
         if not all_citations:
             logger.warning("No citations found")
             return pd.DataFrame()
             
-        df = pd.DataFrame(all_citations)
-        
-        # Sort and save
-        df = df.sort_values(by=['year', 'title'], ascending=[False, True]).reset_index(drop=True)
+        # Sort newest first, then by title, on the plain list rather than in pandas
+        all_citations.sort(key=lambda c: (-int(c['year']) if c.get('year', '').isdigit() else 0, c['title']))
         
+        # Stream rows straight to the CSV
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f"scholar_citations_{scholar_id}_{timestamp}.csv"
-        df.to_csv(filename, index=False)
+        with open(filename, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=self.output_fields)
+            writer.writeheader()
+            writer.writerows(all_citations)
         logger.info(f"Results saved to {filename}")
         
-        return df
+        return pd.DataFrame(all_citations, columns=self.output_fields)
 
 def main():
     """Main function to run the scraper"""
@@ -262,10 +389,10 @@ def main():
     scraper = GoogleScholarScraper()
     logger.info(f"Starting citation scraping for Scholar ID: {scholar_id}")
     
-    citations_df = scraper.get_all_citations(
+    citations_df = asyncio.run(scraper.get_all_citations(
         scholar_id=scholar_id,
         min_year=min_year
-    )
+    ))
     
     if not citations_df.empty:
         logger.info(f"\nFound {len(citations_df)} total citations")
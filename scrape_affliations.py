@@ -1,18 +1,23 @@
 import sys
 import subprocess
-import pkg_resources
+import time
+from urllib.parse import urlparse
+import importlib.util
 import os
 from typing import Dict, List, Optional, Tuple
 import pandas as pd
-import requests
-import time
-import json
+import asyncio
+import aiohttp
+import orjson
+import csv
+from response_cache import cache_key, read_cache, write_cache
 
 def install_required_packages():
     """Install required packages if they're missing."""
-    required = {'requests', 'pandas'}
-    installed = {pkg.key for pkg in pkg_resources.working_set}
-    missing = required - installed
+    missing = set()
+    for pkg in ('aiohttp', 'orjson', 'pandas'):
+        if importlib.util.find_spec(pkg) is None:
+            missing.add(pkg)
     
     if missing:
         print(f"Installing missing packages: {missing}")
@@ -22,31 +27,91 @@ def install_required_packages():
             print("Successfully installed missing packages")
         except subprocess.CalledProcessError:
             print("Error: Failed to install required packages. Please install them manually:")
-            print("pip install requests pandas")
+            print("pip install -r requirements.txt")
             sys.exit(1)
 
 class ComprehensiveAffiliationFinder:
-    def __init__(self):
+    def __init__(self, cache_dir: str = '.cache', cache_ttl: float = 24 * 3600, no_cache: bool = False):
         self.crossref_url = "https://api.crossref.org/works"
         self.openalex_url = "https://api.openalex.org/works"
         self.semantic_scholar_url = "https://api.semanticscholar.org/graph/v1/paper"
         self.headers = {
             "User-Agent": "AffiliationFinder/1.0 (mailto:your-email@example.com)"
         }
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.no_cache = no_cache
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.semaphore: Optional[asyncio.BoundedSemaphore] = None
+        self.output_fields = ["paper_title", "author", "affiliations", "doi"]
+        self.max_concurrency = 20
+        # Retry policy for rate limited or failing API requests
+        self.max_retries = 5
+        self.backoff_factor = 2
+        self.retry_statuses = {429, 500, 502, 503, 504}
+        # Per-host backoff deadlines so a 429 pauses every request to that API
+        self._backoff_until: Dict[str, float] = {}
+        # OpenAlex/Semantic Scholar lookups in flight or done, keyed by DOI
+        self._fallback_affiliations: Dict[str, asyncio.Future] = {}
+        self.limit_per_host = 8
+
+    def _get_retry_wait(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Exponential backoff, preferring the server's Retry-After header when present."""
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+        return self.backoff_factor * 2 ** attempt
+
+    async def _get_json(self, url: str, params: Optional[Dict] = None) -> Dict:
+        """GET a JSON API response, serving fresh responses from the disk cache."""
+        key = cache_key(url, params)
+        if not self.no_cache:
+            content = read_cache(key, self.cache_ttl, self.cache_dir, ext='json')
+            if content is not None:
+                return orjson.loads(content)
+        
+        host = urlparse(url).netloc
+        for attempt in range(self.max_retries + 1):
+            # Honour any backoff triggered by a rate limited request to this host
+            wait_time = self._backoff_until.get(host, 0.0) - time.monotonic()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            
+            async with self.session.get(url, params=params, headers=self.headers) as response:
+                if response.status not in self.retry_statuses or attempt == self.max_retries:
+                    response.raise_for_status()
+                    content = await response.read()
+                    break
+                status = response.status
+                wait_time = self._get_retry_wait(attempt, response.headers.get('Retry-After'))
+            
+            print(f"Request to {host} failed with status {status}. Retrying in {wait_time} seconds...")
+            if status == 429:
+                self._backoff_until[host] = max(self._backoff_until.get(host, 0.0), time.monotonic() + wait_time)
+            else:
+                await asyncio.sleep(wait_time)
+        
+        # Only cache bodies that decode, so a bad response is refetched next time
+        data = orjson.loads(content)
+        write_cache(key, content.decode('utf-8'), self.cache_dir, ext='json')
+        return data
     
     def clean_title(self, title: str) -> str:
         """Clean and normalize paper title."""
-        if pd.isna(title):
+        # title != title only holds for NaN, which avoids pandas' scalar dispatch
+        if title is None or (isinstance(title, float) and title != title):
             return ""
-        return title.replace("[HTML]", "").strip()
+        return str(title).replace("[HTML]", "").strip()
     
     def clean_doi(self, doi: str) -> Optional[str]:
         """Clean and format DOI."""
-        if pd.isna(doi):
+        if doi is None or (isinstance(doi, float) and doi != doi):
             return None
         return str(doi).strip().lower()
 
-    def search_crossref(self, title: str) -> Optional[Dict]:
+    async def search_crossref(self, title: str) -> Optional[Dict]:
         """Search Crossref for paper metadata."""
         try:
             params = {
@@ -54,29 +119,22 @@ class ComprehensiveAffiliationFinder:
                 "select": "author,title,DOI,publisher",
                 "rows": 1
             }
-            response = requests.get(self.crossref_url, params=params, headers=self.headers)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = await self._get_json(self.crossref_url, params=params)
             if data["message"]["items"]:
                 return data["message"]["items"][0]
             return None
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             print(f"Error with Crossref API for title '{title}': {str(e)}")
             return None
 
-    def search_openalex(self, doi: str) -> Optional[List[Tuple[str, str]]]:
+    async def search_openalex(self, doi: str) -> Optional[List[Tuple[str, str]]]:
         """Search OpenAlex for author affiliations."""
         if not doi:
             return None
             
         try:
-            url = f"{self.openalex_url}/doi/{doi}"
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = await self._get_json(f"{self.openalex_url}/doi/{doi}")
             affiliations = []
             
             if "authorships" in data:
@@ -103,23 +161,18 @@ class ComprehensiveAffiliationFinder:
                             
             return affiliations if affiliations else None
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             print(f"Error with OpenAlex API for DOI {doi}: {str(e)}")
             return None
 
-    def search_semantic_scholar(self, doi: str) -> Optional[List[Tuple[str, str]]]:
+    async def search_semantic_scholar(self, doi: str) -> Optional[List[Tuple[str, str]]]:
         """Search Semantic Scholar for author affiliations."""
         if not doi:
             return None
             
         try:
             params = {"fields": "authors.name,authors.affiliations"}
-            response = requests.get(f"{self.semantic_scholar_url}/DOI:{doi}", 
-                                 headers=self.headers, 
-                                 params=params)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = await self._get_json(f"{self.semantic_scholar_url}/DOI:{doi}", params=params)
             affiliations = []
             
             if "authors" in data:
@@ -131,87 +184,158 @@ class ComprehensiveAffiliationFinder:
                             
             return affiliations if affiliations else None
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             print(f"Error with Semantic Scholar API for DOI {doi}: {str(e)}")
             return None
 
-    def process_papers(self, titles: List[str], start_index: int = 0, output_file: str = 'results.csv') -> pd.DataFrame:
-        """Process papers to extract metadata and affiliations with checkpointing."""
+    def _load_checkpoint(self, checkpoint_file: str) -> Optional[int]:
+        """Return the index of the last completed paper, if any."""
+        try:
+            with open(checkpoint_file) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _save_checkpoint(self, checkpoint_file: str, index: int) -> None:
+        """Atomically record the index of the last completed paper."""
+        tmp_file = f"{checkpoint_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(str(index))
+        os.replace(tmp_file, checkpoint_file)
+
+    async def _get_fallback_affiliations(self, doi: str) -> Tuple[Optional[List[Tuple[str, str]]], Optional[List[Tuple[str, str]]]]:
+        """Query OpenAlex and Semantic Scholar concurrently, once per DOI."""
+        if doi not in self._fallback_affiliations:
+            self._fallback_affiliations[doi] = asyncio.gather(
+                self.search_openalex(doi),
+                self.search_semantic_scholar(doi)
+            )
+        return await self._fallback_affiliations[doi]
+
+    async def _process_paper(self, title: str) -> List[Dict]:
+        """Look up authors and affiliations for a single paper."""
         results = []
+        
+        async with self.semaphore:
+            # Step 1: Get initial metadata from Crossref
+            paper_data = await self.search_crossref(title)
+            if not paper_data:
+                return results
+                
+            doi = paper_data.get("DOI")
+            
+            # Get affiliations from paper_data
+            authors = []
+            for author in paper_data.get("author", []):
+                name = f"{author.get('given', '')} {author.get('family', '')}".strip()
+                affiliations = []
+                
+                if "affiliation" in author:
+                    for affiliation in author["affiliation"]:
+                        if isinstance(affiliation, dict) and "name" in affiliation:
+                            affiliations.append(affiliation["name"])
+                authors.append((name, affiliations))
+            
+            # If Crossref is missing any affiliations, fetch both fallbacks at once
+            openalex_affiliations = semantic_affiliations = None
+            if doi and any(not affiliations for _, affiliations in authors):
+                openalex_affiliations, semantic_affiliations = await self._get_fallback_affiliations(doi)
+        
+        # Lowercase fallback author names once per paper rather than per comparison
+        openalex_low = [(a.lower(), aff) for a, aff in openalex_affiliations or []]
+        semantic_low = [(a.lower(), aff) for a, aff in semantic_affiliations or []]
+        
+        for name, affiliations in authors:
+            name_low = name.lower()
+            
+            # If no affiliations found in Crossref, try OpenAlex
+            if not affiliations:
+                for al, affiliation in openalex_low:
+                    if name_low in al or al in name_low:
+                        affiliations.append(affiliation)
+            
+            # If still no affiliations, try Semantic Scholar
+            if not affiliations:
+                for al, affiliation in semantic_low:
+                    if name_low in al or al in name_low:
+                        affiliations.append(affiliation)
+            
+            results.append({
+                "paper_title": title,
+                "author": name,
+                "affiliations": "; ".join(affiliations) if affiliations else "Not found",
+                "doi": doi or "Not found"
+            })
+        
+        return results
+
+    async def process_papers(self, titles: List[str], start_index: int = 0, output_file: str = 'results.csv') -> int:
+        """Process papers concurrently, streaming affiliations to output_file with checkpointing.
+        Returns the number of papers processed in this run."""
         papers_processed = 0
         affiliations_found = 0
         
-        # Load existing results if any
-        if os.path.exists(output_file):
-            existing_df = pd.read_csv(output_file)
-            results = existing_df.to_dict('records')
-            print(f"Loaded {len(results)} existing results from {output_file}")
+        # Resume after the last completed paper; earlier rows stay on disk untouched
+        checkpoint_file = f"{output_file}.checkpoint"
+        last_completed = self._load_checkpoint(checkpoint_file)
+        if last_completed is not None and last_completed + 1 > start_index:
+            start_index = last_completed + 1
+            print(f"Resuming from paper {start_index + 1} using {checkpoint_file}")
+        
+        self.semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        self._fallback_affiliations = {}
+        # One pool per host so each API is limited independently
+        connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+        timeout = aiohttp.ClientTimeout(total=30)
         
-        for i, title in enumerate(titles[start_index:], start=start_index):
-            print(f"\nProcessing paper {i + 1}/{len(titles)}: {title}")
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            papers = list(enumerate(titles[start_index:], start=start_index))
+            tasks = [asyncio.ensure_future(self._process_paper(title)) for _, title in papers]
+            
+            # Stream rows to the CSV instead of rewriting it after every paper
+            write_header = not os.path.exists(output_file) or os.path.getsize(output_file) == 0
             
             try:
-                # Step 1: Get initial metadata from Crossref
-                paper_data = self.search_crossref(title)
-                if paper_data:
-                    doi = paper_data.get("DOI")
+                with open(output_file, 'a', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=self.output_fields)
+                    if write_header:
+                        writer.writeheader()
                     
-                    # Get affiliations from paper_data
-                    for author in paper_data.get("author", []):
-                        name = f"{author.get('given', '')} {author.get('family', '')}".strip()
-                        affiliations = []
-                        
-                        if "affiliation" in author:
-                            for affiliation in author["affiliation"]:
-                                if isinstance(affiliation, dict) and "name" in affiliation:
-                                    affiliations.append(affiliation["name"])
-                        
-                        # If no affiliations found in Crossref, try OpenAlex
-                        if not affiliations and doi:
-                            openalex_affiliations = self.search_openalex(doi)
-                            if openalex_affiliations:
-                                for aff_author, affiliation in openalex_affiliations:
-                                    if name.lower() in aff_author.lower() or aff_author.lower() in name.lower():
-                                        affiliations.append(affiliation)
-                        
-                        # If still no affiliations, try Semantic Scholar
-                        if not affiliations and doi:
-                            semantic_affiliations = self.search_semantic_scholar(doi)
-                            if semantic_affiliations:
-                                for aff_author, affiliation in semantic_affiliations:
-                                    if name.lower() in aff_author.lower() or aff_author.lower() in name.lower():
-                                        affiliations.append(affiliation)
-                        
-                        result = {
-                            "paper_title": title,
-                            "author": name,
-                            "affiliations": "; ".join(affiliations) if affiliations else "Not found",
-                            "doi": doi or "Not found"
-                        }
-                        results.append(result)
+                    # Consume results in order so the checkpoint always covers a contiguous prefix
+                    for n, (i, title) in enumerate(papers):
+                        # Drop each task once consumed so its rows can be freed
+                        task, tasks[n] = tasks[n], None
+                        try:
+                            paper_results = await task
+                            print(f"\nProcessed paper {i + 1}/{len(titles)}: {title}")
+                            
+                            affiliations_found += sum(1 for r in paper_results if r["affiliations"] != "Not found")
+                            
+                            # Save checkpoint after each paper
+                            writer.writerows(paper_results)
+                            f.flush()
+                            self._save_checkpoint(checkpoint_file, i)
+                            print(f"Saved checkpoint after processing paper {i + 1}")
+                            
+                        except Exception as e:
+                            print(f"Error processing paper {title}: {str(e)}")
+                            # Continue with next paper even if current one fails
+                            continue
                         
-                        if affiliations:
-                            affiliations_found += 1
-                
-                # Save checkpoint after each paper
-                checkpoint_df = pd.DataFrame(results)
-                checkpoint_df.to_csv(output_file, index=False)
-                print(f"Saved checkpoint after processing paper {i + 1}")
-                
-            except Exception as e:
-                print(f"Error processing paper {title}: {str(e)}")
-                # Continue with next paper even if current one fails
-                continue
-            
-            papers_processed += 1
-            time.sleep(1)  # Be nice to APIs
+                        papers_processed += 1
+            finally:
+                for task in tasks:
+                    if task is not None:
+                        task.cancel()
+                self.session = None
             
         print(f"\nProcessed {papers_processed} papers")
         print(f"Found affiliations for {affiliations_found} authors")
         
-        return pd.DataFrame(results)
+        return papers_processed
     
-    def main():
+def main():
     # Command line arguments for start index
     #start_index = int(sys.argv[1]) if len(sys.argv) > 1 else 0
     start_index = 0
@@ -221,9 +345,9 @@ class ComprehensiveAffiliationFinder:
     output_file = 'scholar_citations_{scholar_id}_{timestamp}_affliations.csv' # change this
     
     try:
-        # Read titles
+        # Read titles, looking up papers that cite several of the author's works only once
         df = pd.read_csv(input_file)
-        titles = df['title'].tolist()
+        titles = df['title'].dropna().drop_duplicates().tolist()
         
         if start_index >= len(titles):
             print(f"Error: Start index {start_index} is greater than number of papers {len(titles)}")
@@ -231,16 +355,14 @@ class ComprehensiveAffiliationFinder:
         
         # Initialize finder and process papers
         finder = ComprehensiveAffiliationFinder()
-        results_df = finder.process_papers(titles, start_index=start_index, output_file=output_file)
-        
-        # Final save (though it should already be saved from checkpoints)
-        results_df.to_csv(output_file, index=False)
+        papers_processed = asyncio.run(finder.process_papers(titles, start_index=start_index, output_file=output_file))
         
-        # Print summary
+        # Print summary from a single pass over the affiliations column
+        affiliations = pd.read_csv(output_file, usecols=['affiliations'])['affiliations']
         print("\nFinal Summary:")
-        print(f"Total papers processed: {len(titles) - start_index}")
-        print(f"Total authors found: {len(results_df)}")
-        print(f"Authors with affiliations: {len(results_df[results_df['affiliations'] != 'Not found'])}")
+        print(f"Total papers processed: {papers_processed}")
+        print(f"Total authors found: {len(affiliations)}")
+        print(f"Authors with affiliations: {(affiliations != 'Not found').sum()}")
         print(f"Results saved to: {output_file}")
         
     except FileNotFoundError: